@@ -1,18 +1,28 @@
 import os
-import subprocess
 import json
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify, redirect, make_response
+import asyncio
+import functools
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from flask import (
+    Flask, Response, render_template, request, jsonify, redirect, make_response
+)
 from flask_cors import CORS
 from dotenv import load_dotenv
+from yt_dlp import YoutubeDL
+from cachetools import TTLCache
+from apscheduler.schedulers.background import BackgroundScheduler
 
 load_dotenv()
 
 from database import (
     init_db, get_or_create_user, get_user_by_id,
     create_auth_token, verify_auth_token, cleanup_expired_tokens,
-    add_to_history, get_user_history,
-    get_cached_stream, cache_stream, cleanup_old_cache,
+    cleanup_expired_sessions,
+    add_to_history, add_to_history_many, get_user_history,
+    get_cached_stream, cache_stream, cache_stream_error, cleanup_old_cache,
     get_user_count
 )
 from auth import (
@@ -23,6 +33,74 @@ from auth import (
 
 app = Flask(__name__)
 
+MAGIC_LINK_TTL = timedelta(minutes=15)
+
+# yt-dlp options per use; YoutubeDL isn't thread-safe, so each thread gets its own instances
+_YDL_OPTS = {
+    'search': {
+        'quiet': True, 'no_warnings': True, 'skip_download': True,
+        'extract_flat': True, 'socket_timeout': 30
+    },
+    'meta': {
+        'quiet': True, 'no_warnings': True, 'skip_download': True,
+        'socket_timeout': 15
+    },
+    'stream': {
+        'quiet': True, 'no_warnings': True, 'skip_download': True,
+        'format': 'bestaudio', 'socket_timeout': 30
+    },
+}
+_ydl_local = threading.local()
+
+def _ydl(kind):
+    """Get this thread's YoutubeDL instance for 'search', 'meta' or 'stream'"""
+    ydl = getattr(_ydl_local, kind, None)
+    if ydl is None:
+        ydl = YoutubeDL(_YDL_OPTS[kind])
+        setattr(_ydl_local, kind, ydl)
+    return ydl
+
+# Shared executors for blocking calls made from async views. Flask runs each
+# async view on its own short-lived event loop, so the loop's default executor
+# would be rebuilt per request; these live with the process. DB calls get their
+# own executor so quick lookups never queue behind slow yt-dlp extractions.
+_YDL_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('YDL_THREADS', 32)), thread_name_prefix='yt-dlp'
+)
+_DB_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('DB_THREADS', 16)), thread_name_prefix='db'
+)
+# Max concurrent extractions a single batch metadata request may start
+BATCH_FANOUT = 8
+
+async def _run_in(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+async def run_ydl(func, *args, **kwargs):
+    """Run a blocking yt-dlp call off the event loop"""
+    return await _run_in(_YDL_EXECUTOR, func, *args, **kwargs)
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database call off the event loop"""
+    return await _run_in(_DB_EXECUTOR, func, *args, **kwargs)
+
+# Per-process caches (stream URLs carry signed expirations, so keep them shorter)
+_META_CACHE = TTLCache(maxsize=4096, ttl=24 * 3600)
+_STREAM_MEM_CACHE = TTLCache(maxsize=4096, ttl=3 * 3600)
+# Recent yt-dlp failures (unavailable, geo-blocked, rate-limited) so they aren't retried on every click
+_META_FAIL_CACHE = TTLCache(maxsize=4096, ttl=10 * 60)
+_STREAM_FAIL_CACHE = TTLCache(maxsize=4096, ttl=10 * 60)
+_CACHE_LOCK = threading.Lock()
+
+def _cache_get(cache, key):
+    with _CACHE_LOCK:
+        return cache.get(key)
+
+def _cache_set(cache, key, value):
+    with _CACHE_LOCK:
+        cache[key] = value
+
 # Enable CORS for API routes
 CORS(app, resources={
     r"/api/*": {
@@ -45,6 +123,31 @@ if os.environ.get('DATABASE_URL'):
     except Exception as e:
         print(f"Database init error: {e}")
 
+# Import yt-dlp's YouTube extractors in the background so the first search doesn't pay for it
+def _warmup():
+    try:
+        from yt_dlp.extractor.youtube import YoutubeIE, YoutubeSearchIE  # noqa: F401
+    except Exception as e:
+        print(f"yt-dlp warmup error: {e}")
+
+threading.Thread(target=_warmup, daemon=True).start()
+
+# Periodic cleanup, kept off the request path. Every worker schedules it, but the
+# jobs take a Postgres advisory lock so only one run per table happens at a time.
+if os.environ.get('DATABASE_URL') and not os.environ.get('FLASK_DEBUG'):
+    _sched = BackgroundScheduler(daemon=True)
+    _sched.add_job(cleanup_expired_tokens, 'interval', minutes=15)
+    _sched.add_job(cleanup_old_cache, 'interval', hours=1)
+    _sched.add_job(cleanup_expired_sessions, 'interval', hours=1)
+    _sched.start()
+
+def cacheable(response, max_age):
+    """Mark a response as publicly cacheable with an ETag, answering 304 on a match"""
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.add_etag()
+    return response.make_conditional(request)
+
 # ============== Pages ==============
 
 @app.route('/')
@@ -63,7 +166,7 @@ def get_stats():
     except:
         count = 0
 
-    return jsonify({
+    return cacheable(jsonify({
         'user_count': count,
         'free_slots': max(0, 20 - count),
         'pricing': {
@@ -71,7 +174,7 @@ def get_stats():
             'paid_tier': 100,
             'price': '$1/month'
         }
-    })
+    }), max_age=60)
 
 # ============== Auth Routes ==============
 
@@ -86,7 +189,7 @@ def request_magic_link():
 
     # Generate token
     token = generate_magic_token()
-    expires_at = datetime.utcnow() + timedelta(minutes=15)
+    expires_at = datetime.now(timezone.utc) + MAGIC_LINK_TTL
 
     # Store token
     create_auth_token(email, token, expires_at)
@@ -98,7 +201,7 @@ def request_magic_link():
         return jsonify({'error': 'Failed to send email'}), 500
 
 @app.route('/auth/verify')
-def verify_magic_link():
+async def verify_magic_link():
     """Verify magic link and log user in"""
     token = request.args.get('token')
 
@@ -106,19 +209,16 @@ def verify_magic_link():
         return redirect('/?error=invalid_link')
 
     # Verify token
-    email = verify_auth_token(token)
+    email = await run_db(verify_auth_token, token)
     if not email:
         return redirect('/?error=expired_link')
 
     # Get or create user
-    user = get_or_create_user(email)
+    user = await run_db(get_or_create_user, email)
 
     # Create response with session cookie
     response = make_response(redirect('/?logged_in=true'))
-    set_session_cookie(response, user['id'])
-
-    # Cleanup old tokens
-    cleanup_expired_tokens()
+    await run_db(set_session_cookie, response, user['id'])
 
     return response
 
@@ -148,8 +248,44 @@ def logout():
 
 # ============== Search ==============
 
+def _search_result(data):
+    """Shape a flat yt-dlp search entry for the frontend"""
+    video_id = data.get('id')
+    duration = data.get('duration')
+    return {
+        'id': video_id,
+        'title': data.get('title'),
+        'channel': data.get('channel') or data.get('uploader', 'Unknown'),
+        'duration': duration,
+        'duration_raw': duration or 0,
+        'upload_date': '',
+        'upload_timestamp': 0,
+        'views': '',
+        'view_count': 0,
+        'url': f"https://youtube.com/watch?v={video_id}"
+    }
+
+def _start_search(search_url):
+    """Start a lazy search and pull its first result.
+
+    The rest of the entries are consumed later by the response generator on
+    another thread, so the search gets its own YoutubeDL instead of a
+    thread-local one.
+    """
+    ydl = YoutubeDL(_YDL_OPTS['search'])
+    # process=False leaves entries as a lazy generator fed page by page
+    info = ydl.extract_info(search_url, download=False, process=False)
+    entries = itertools.islice(info.get('entries') or [], 18)
+    return next(entries, None), entries
+
 @app.route('/api/search')
-def search():
+async def search():
+    """Search YouTube.
+
+    Returns a JSON array by default. Clients sending Accept: application/x-ndjson
+    get one result per line as each is extracted, ending with an {"error": ...}
+    line if extraction fails partway.
+    """
     query = request.args.get('q', '')
     date_filter = request.args.get('date', '')
     if not query:
@@ -161,75 +297,56 @@ def search():
         'month': 'EgIIBA%3D%3D',
         'year': 'EgIIBQ%3D%3D',
     }
+    wants_stream = request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson']
+    ) == 'application/x-ndjson'
 
     try:
         if date_filter and date_filter in date_filters:
             from urllib.parse import quote
             search_url = f'https://www.youtube.com/results?search_query={quote(query)}&sp={date_filters[date_filter]}'
-            cmd = [
-                'yt-dlp', search_url,
-                '--flat-playlist', '--dump-json', '--no-warnings',
-                '--playlist-end', '18'
-            ]
         else:
-            cmd = [
-                'yt-dlp', f'ytsearch18:{query}',
-                '--flat-playlist', '--dump-json', '--no-warnings'
-            ]
-
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-
-        videos = []
-        for line in result.stdout.strip().split('\n'):
-            if line:
-                try:
-                    data = json.loads(line)
-                    video_id = data.get('id')
-                    duration = data.get('duration')
-                    videos.append({
-                        'id': video_id,
-                        'title': data.get('title'),
-                        'channel': data.get('channel') or data.get('uploader', 'Unknown'),
-                        'duration': duration,
-                        'duration_raw': duration or 0,
-                        'upload_date': '',
-                        'upload_timestamp': 0,
-                        'views': '',
-                        'view_count': 0,
-                        'url': f"https://youtube.com/watch?v={video_id}"
-                    })
-                except json.JSONDecodeError:
-                    continue
-
-        return jsonify(videos)
-    except subprocess.TimeoutExpired:
-        return jsonify({'error': 'Search timeout'}), 504
+            search_url = f'ytsearch18:{query}'
+
+        # Pull the first result up front so failures still get an error status
+        first, entries = await run_ydl(_start_search, search_url)
+        if not wants_stream:
+            rest = await run_ydl(list, entries)
+            return jsonify([_search_result(d) for d in [first, *rest] if d])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+    def generate():
+        try:
+            for data in itertools.chain([first], entries):
+                if data:
+                    yield json.dumps(_search_result(data)) + '\n'
+        except Exception as e:
+            yield json.dumps({'error': str(e)}) + '\n'
+
+    # No stream_with_context: it would push the request context inside the async
+    # view's event loop, which Flask then can't pop. generate() doesn't need it.
+    return Response(generate(), mimetype='application/x-ndjson')
+
 # ============== Metadata ==============
 
-@app.route('/api/metadata/<video_id>')
-def get_metadata(video_id):
-    """Fetch metadata for a single video"""
-    try:
-        cmd = [
-            'yt-dlp', f'https://youtube.com/watch?v={video_id}',
-            '--dump-json', '--no-warnings', '--no-download'
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
+def _fetch_meta(video_id):
+    """Fetch metadata for a single video via yt-dlp"""
+    if _cache_get(_META_FAIL_CACHE, video_id):
+        return {'id': video_id, 'error': True}
 
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
+    try:
+        data = _ydl('meta').extract_info(f'https://youtube.com/watch?v={video_id}', download=False)
 
+        if data:
             # Try to get precise timestamp first, fall back to date
             upload_timestamp = data.get('timestamp') or data.get('release_timestamp') or 0
             upload_date = data.get('upload_date', '')
 
             if upload_timestamp:
                 # We have precise time - return ISO format
-                dt = datetime.utcfromtimestamp(upload_timestamp)
-                upload_date = dt.isoformat() + 'Z'
+                dt = datetime.fromtimestamp(upload_timestamp, timezone.utc)
+                upload_date = dt.isoformat().replace('+00:00', 'Z')
             elif upload_date and len(upload_date) == 8:
                 # Only have date - format as YYYY-MM-DD
                 upload_date = f"{upload_date[:4]}-{upload_date[4:6]}-{upload_date[6:8]}"
@@ -244,56 +361,133 @@ def get_metadata(video_id):
             else:
                 view_str = ""
 
-            return jsonify({
+            payload = {
                 'id': video_id,
                 'upload_date': upload_date,
                 'upload_timestamp': upload_timestamp,
                 'views': view_str,
                 'view_count': views
-            })
+            }
+            _cache_set(_META_CACHE, video_id, payload)
+            return payload
     except:
         pass
 
-    return jsonify({'id': video_id, 'error': True})
+    _cache_set(_META_FAIL_CACHE, video_id, True)
+    return {'id': video_id, 'error': True}
+
+@app.route('/api/metadata/<video_id>')
+async def get_metadata(video_id):
+    """Fetch metadata for a single video"""
+    meta = _cache_get(_META_CACHE, video_id)
+    if not meta:
+        meta = await run_ydl(_fetch_meta, video_id)
+    if meta.get('error'):
+        return jsonify(meta)
+    return cacheable(jsonify(meta), max_age=3600)
+
+@app.route('/api/metadata/batch', methods=['GET', 'POST'])
+async def get_metadata_batch():
+    """Fetch metadata for several videos in one request, keyed by video id"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        ids = data.get('ids') if isinstance(data, dict) else None
+        if not isinstance(ids, list):
+            return jsonify({'error': 'ids must be a list'}), 400
+    else:
+        ids = request.args.get('ids', '').split(',')
+    ids = list(dict.fromkeys(v for v in ids if isinstance(v, str) and v))[:50]
+
+    out = {}
+    missing = []
+    for vid in ids:
+        cached = _cache_get(_META_CACHE, vid)
+        if cached:
+            out[vid] = cached
+        else:
+            missing.append(vid)
+
+    fanout = asyncio.Semaphore(BATCH_FANOUT)
+
+    async def fetch(vid):
+        async with fanout:
+            return await run_ydl(_fetch_meta, vid)
+
+    results = await asyncio.gather(*(fetch(vid) for vid in missing))
+    out.update(zip(missing, results))
+    if request.method == 'POST' or any(m.get('error') for m in out.values()):
+        return jsonify(out)
+    return cacheable(jsonify(out), max_age=3600)
 
 # ============== Streaming ==============
 
+def _extract_stream(video_id):
+    return _ydl('stream').extract_info(f'https://youtube.com/watch?v={video_id}', download=False)
+
 @app.route('/api/stream/<video_id>')
-def stream(video_id):
+async def stream(video_id):
     """Get audio stream URL (with caching)"""
     # Check cache first
+    cached_url = _cache_get(_STREAM_MEM_CACHE, video_id)
+    if cached_url:
+        return jsonify({'url': cached_url, 'cached': True})
+    if _cache_get(_STREAM_FAIL_CACHE, video_id):
+        return jsonify({'error': 'Failed to get stream', 'cached': True}), 500
+
     if os.environ.get('DATABASE_URL'):
-        cached_url = get_cached_stream(video_id)
-        if cached_url:
-            return jsonify({'url': cached_url, 'cached': True})
+        cached = await run_db(get_cached_stream, video_id)
+        # A DB error row isn't copied into memory: that would restart its 10 minutes
+        if cached and cached['error']:
+            return jsonify({'error': 'Failed to get stream', 'cached': True}), 500
+        if cached:
+            return jsonify({'url': cached['audio_url'], 'cached': True})
 
     try:
-        cmd = [
-            'yt-dlp', f'https://youtube.com/watch?v={video_id}',
-            '-f', 'bestaudio', '-g', '--no-warnings'
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-
-        if result.returncode == 0:
-            audio_url = result.stdout.strip().split('\n')[0]
-
-            # Cache the URL
-            if os.environ.get('DATABASE_URL'):
-                cache_stream(video_id, audio_url)
-
-            return jsonify({'url': audio_url})
-        else:
-            return jsonify({'error': 'Failed to get stream'}), 500
+        info = await run_ydl(_extract_stream, video_id)
+        audio_url = info.get('url') if info else None
+        if not audio_url and info and info.get('requested_formats'):
+            audio_url = info['requested_formats'][0].get('url')
+        error = None if audio_url else 'Failed to get stream'
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        audio_url, error = None, str(e)
+
+    if error:
+        # Negative-cache the failure briefly
+        _cache_set(_STREAM_FAIL_CACHE, video_id, True)
+        if os.environ.get('DATABASE_URL'):
+            try:
+                await run_db(cache_stream_error, video_id)
+            except Exception as e:
+                print(f"Stream cache error: {e}")
+        return jsonify({'error': error}), 500
+
+    # Cache the URL
+    _cache_set(_STREAM_MEM_CACHE, video_id, audio_url)
+    if os.environ.get('DATABASE_URL'):
+        try:
+            await run_db(cache_stream, video_id, audio_url)
+        except Exception as e:
+            print(f"Stream cache error: {e}")
+
+    return jsonify({'url': audio_url})
 
 # ============== History ==============
 
 @app.route('/api/history', methods=['GET'])
 @login_required
 def get_history(user_id):
-    """Get user's listening history"""
-    history = get_user_history(user_id, limit=50)
+    """Get user's listening history (?before=<viewed_at>&before_id=<id> for the next page)"""
+    before = None
+    if request.args.get('before'):
+        try:
+            before = (
+                datetime.fromisoformat(request.args['before']),
+                int(request.args['before_id'])
+            )
+        except (KeyError, ValueError):
+            return jsonify({'error': 'before and before_id required together'}), 400
+
+    history = get_user_history(user_id, limit=50, before=before)
     # Convert datetime to ISO format
     for item in history:
         if item.get('viewed_at'):
@@ -316,8 +510,33 @@ def add_history(user_id):
     add_to_history(user_id, video_id, title, channel, duration)
     return jsonify({'ok': True})
 
+@app.route('/api/history/batch', methods=['POST'])
+@login_required
+def add_history_batch(user_id):
+    """Add several plays to user's listening history at once"""
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+
+    if not items or not isinstance(items, list) or \
+            not all(isinstance(i, dict) and i.get('video_id') for i in items):
+        return jsonify({'error': 'items with video_id required'}), 400
+    if len(items) > 100:
+        return jsonify({'error': 'Too many items'}), 400
+
+    # Optional per-item play time (ISO 8601), so buffered plays keep their order
+    for i in items:
+        if i.get('viewed_at'):
+            try:
+                i['viewed_at'] = datetime.fromisoformat(i['viewed_at'])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'Invalid viewed_at timestamp'}), 400
+
+    add_to_history_many(user_id, items)
+    return jsonify({'ok': True, 'count': len(items)})
+
 # ============== Utilities ==============
 
+@functools.lru_cache(maxsize=8192)
 def format_duration(seconds):
     if not seconds:
         return '--:--'
@@ -1,20 +1,30 @@
 import os
 import secrets
+import threading
 import jwt
-from datetime import datetime, timedelta
+from datetime import timedelta
 from functools import wraps
 from flask import request, jsonify, redirect, make_response
+from cachetools import TTLCache
 import resend
 
+from database import create_session, get_session_user_id, delete_session
+
 SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-change-in-production')
 APP_URL = os.environ.get('APP_URL', 'http://localhost:5050')
 FROM_EMAIL = os.environ.get('FROM_EMAIL', 'login@audiotube.mordechaipotash.com')
 RESEND_API_KEY = os.environ.get('RESEND_API_KEY')
+SESSION_TTL = timedelta(days=30)
 
 # Initialize resend
 if RESEND_API_KEY:
     resend.api_key = RESEND_API_KEY
 
+# Recently seen sessions (token -> user_id), so most requests skip the DB.
+# A revoked session can stay valid in other workers for up to the TTL.
+_SESSION_CACHE = TTLCache(maxsize=10000, ttl=300)
+_SESSION_LOCK = threading.Lock()
+
 def generate_magic_token():
     """Generate a secure random token"""
     return secrets.token_urlsafe(32)
@@ -56,17 +66,16 @@ def send_magic_link(email, token):
         print(f"Email error: {e}")
         return False
 
-def create_session_token(user_id, days=30):
-    """Create a JWT session token"""
-    payload = {
-        'user_id': user_id,
-        'exp': datetime.utcnow() + timedelta(days=days),
-        'iat': datetime.utcnow()
-    }
-    return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
+def create_session_token(user_id, days=SESSION_TTL.days):
+    """Create an opaque session token backed by the sessions table"""
+    token = secrets.token_urlsafe(32)
+    create_session(token, user_id, days)
+    with _SESSION_LOCK:
+        _SESSION_CACHE[token] = user_id
+    return token
 
-def decode_session_token(token):
-    """Decode and verify a session token"""
+def _decode_jwt_session(token):
+    """Decode a legacy JWT session token"""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
         return payload.get('user_id')
@@ -75,6 +84,23 @@ def decode_session_token(token):
     except jwt.InvalidTokenError:
         return None
 
+def decode_session_token(token):
+    """Resolve a session token to a user ID"""
+    with _SESSION_LOCK:
+        user_id = _SESSION_CACHE.get(token)
+    if user_id:
+        return user_id
+
+    # Legacy JWT sessions contain dots; opaque tokens never do
+    if '.' in token:
+        return _decode_jwt_session(token)
+
+    user_id = get_session_user_id(token)
+    if user_id:
+        with _SESSION_LOCK:
+            _SESSION_CACHE[token] = user_id
+    return user_id
+
 def get_current_user_id():
     """Get current user ID from cookie"""
     token = request.cookies.get('session')
@@ -110,11 +136,16 @@ def set_session_cookie(response, user_id):
         httponly=True,
         secure=is_prod,
         samesite='Lax',
-        max_age=30 * 24 * 60 * 60  # 30 days
+        max_age=int(SESSION_TTL.total_seconds())
     )
     return response
 
 def clear_session_cookie(response):
-    """Clear session cookie"""
+    """Revoke the current session and clear its cookie"""
+    token = request.cookies.get('session')
+    if token and '.' not in token:
+        with _SESSION_LOCK:
+            _SESSION_CACHE.pop(token, None)
+        delete_session(token)
     response.delete_cookie('session')
     return response
@@ -1,22 +1,87 @@
 import os
+import time
+import threading
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, execute_values
 from contextlib import contextmanager
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 20))
+DB_POOL_TIMEOUT = 30  # seconds to wait for a free connection
+DB_POOL_RECYCLE = 30 * 60  # seconds before a pooled connection is reopened
+CLEANUP_BATCH_SIZE = 1000
+CLEANUP_BATCH_SLEEP = 0.05  # seconds between cleanup batches
+
+class _Connection(psycopg2.extensions.connection):
+    """Connection that remembers when it was opened"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.born = time.monotonic()
+
+# Idle connections kept open for reuse; at most DB_POOL_MAX are checked out at once
+_IDLE = []
+_IDLE_LOCK = threading.Lock()
+_SLOTS = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def _alive(conn):
+    """Check an idle connection without a round-trip.
+
+    poll() reads whatever the server has sent; a connection closed by a
+    Postgres restart or an idle timeout raises here instead of in the caller.
+    """
+    try:
+        conn.poll()
+        return not conn.closed
+    except psycopg2.Error:
+        return False
+
+def _checkout():
+    """Get a live connection, reusing an idle one when possible"""
+    while True:
+        with _IDLE_LOCK:
+            conn = _IDLE.pop() if _IDLE else None
+        if conn is None:
+            break
+        if not conn.closed and time.monotonic() - conn.born < DB_POOL_RECYCLE and _alive(conn):
+            return conn
+        conn.close()
+
+    for attempt in range(3):
+        try:
+            return psycopg2.connect(
+                DATABASE_URL, connection_factory=_Connection, cursor_factory=RealDictCursor
+            )
+        except psycopg2.OperationalError:
+            if attempt == 2:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
 
 @contextmanager
 def get_db():
-    """Context manager for database connections"""
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    """Context manager for pooled database connections"""
+    if not _SLOTS.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.OperationalError('Timed out waiting for a database connection')
+    try:
+        conn = _checkout()
+    except Exception:
+        _SLOTS.release()
+        raise
+
     try:
         yield conn
         conn.commit()
     except Exception:
-        conn.rollback()
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass  # connection is dead; dropped below
         raise
     finally:
-        conn.close()
+        if not conn.closed:
+            with _IDLE_LOCK:
+                _IDLE.append(conn)
+        _SLOTS.release()
 
 def init_db():
     """Initialize database schema"""
@@ -66,34 +131,63 @@ def init_db():
             )
         """)
 
+        # Failed lookups are cached too (audio_url NULL, error set).
+        # Only alter when needed: ALTER COLUMN takes an exclusive lock on every boot.
+        cur.execute("""
+            SELECT is_nullable FROM information_schema.columns
+            WHERE table_schema = current_schema()
+            AND table_name = 'stream_cache' AND column_name = 'audio_url'
+        """)
+        if cur.fetchone()['is_nullable'] == 'NO':
+            cur.execute("ALTER TABLE stream_cache ALTER COLUMN audio_url DROP NOT NULL")
+        cur.execute("ALTER TABLE stream_cache ADD COLUMN IF NOT EXISTS error VARCHAR(32)")
+
+        # Login sessions
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                token VARCHAR(64) PRIMARY KEY,
+                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+                expires_at TIMESTAMP NOT NULL,
+                created_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+
         # Create indexes
+        # (viewed_at, id) is the history page cursor; replaces idx_history_user
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_history_user_seek
+            ON view_history(user_id, viewed_at DESC, id DESC)
+        """)
+        cur.execute("DROP INDEX IF EXISTS idx_history_user")
+        cur.execute("DROP INDEX IF EXISTS idx_tokens_lookup")
         cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_history_user
-            ON view_history(user_id, viewed_at DESC)
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_tokens_active
+            ON auth_tokens(token) WHERE used = FALSE
         """)
         cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_tokens_lookup
-            ON auth_tokens(token, expires_at)
+            CREATE INDEX IF NOT EXISTS idx_cache_vid_cover
+            ON stream_cache(video_id) INCLUDE (audio_url, error, cached_at)
         """)
         cur.execute("""
             CREATE INDEX IF NOT EXISTS idx_cache_age
             ON stream_cache(cached_at)
         """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_sessions_expiry
+            ON sessions(expires_at)
+        """)
 
 # User operations
 def get_or_create_user(email):
     """Get existing user or create new one"""
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT id, email FROM users WHERE email = %s", (email,))
-        user = cur.fetchone()
-        if user:
-            return dict(user)
-
-        cur.execute(
-            "INSERT INTO users (email) VALUES (%s) RETURNING id, email",
-            (email,)
-        )
+        # The no-op DO UPDATE makes RETURNING yield the existing row too
+        cur.execute("""
+            INSERT INTO users (email) VALUES (%s)
+            ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email
+            RETURNING id, email
+        """, (email,))
         return dict(cur.fetchone())
 
 def get_user_by_id(user_id):
@@ -119,21 +213,77 @@ def verify_auth_token(token):
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("""
-            SELECT email FROM auth_tokens
+            UPDATE auth_tokens SET used = TRUE
             WHERE token = %s AND expires_at > NOW() AND used = FALSE
+            RETURNING email
         """, (token,))
         row = cur.fetchone()
+        return row['email'] if row else None
 
-        if row:
-            cur.execute("UPDATE auth_tokens SET used = TRUE WHERE token = %s", (token,))
-            return row['email']
-        return None
+def _delete_in_batches(table, where, params=()):
+    """Delete matching rows in small committed batches to keep locks short.
+
+    Every worker schedules cleanup, so a session advisory lock per table
+    makes concurrent runs skip instead of contending on the same rows.
+    """
+    total = 0
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s)) AS locked", (f'cleanup:{table}',))
+        if not cur.fetchone()['locked']:
+            return 0
+        try:
+            while True:
+                cur.execute(f"""
+                    DELETE FROM {table} WHERE ctid IN (
+                        SELECT ctid FROM {table} WHERE {where} LIMIT %s
+                    )
+                """, (*params, CLEANUP_BATCH_SIZE))
+                deleted = cur.rowcount
+                conn.commit()
+                total += deleted
+                if deleted < CLEANUP_BATCH_SIZE:
+                    return total
+                time.sleep(CLEANUP_BATCH_SLEEP)
+        finally:
+            if not conn.closed:
+                conn.rollback()
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (f'cleanup:{table}',))
 
 def cleanup_expired_tokens():
     """Remove expired tokens"""
+    return _delete_in_batches('auth_tokens', "expires_at < NOW() OR used = TRUE")
+
+# Session operations
+def create_session(token, user_id, days=30):
+    """Store a login session"""
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("DELETE FROM auth_tokens WHERE expires_at < NOW() OR used = TRUE")
+        cur.execute(
+            "INSERT INTO sessions (token, user_id, expires_at) VALUES (%s, %s, NOW() + make_interval(days => %s))",
+            (token, user_id, days)
+        )
+
+def get_session_user_id(token):
+    """Get the user ID for a live session"""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT user_id FROM sessions WHERE token = %s AND expires_at > NOW()",
+            (token,)
+        )
+        row = cur.fetchone()
+        return row['user_id'] if row else None
+
+def delete_session(token):
+    """Revoke a login session"""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM sessions WHERE token = %s", (token,))
+
+def cleanup_expired_sessions():
+    """Remove expired sessions"""
+    return _delete_in_batches('sessions', "expires_at < NOW()")
 
 # History operations
 def add_to_history(user_id, video_id, title, channel, duration):
@@ -145,50 +295,87 @@ def add_to_history(user_id, video_id, title, channel, duration):
             VALUES (%s, %s, %s, %s, %s)
         """, (user_id, video_id, title, channel, duration))
 
-def get_user_history(user_id, limit=50):
-    """Get user's view history"""
+def add_to_history_many(user_id, items):
+    """Add several videos to user's history in one statement"""
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT video_id, title, channel, duration, viewed_at
-            FROM view_history
-            WHERE user_id = %s
-            ORDER BY viewed_at DESC
-            LIMIT %s
-        """, (user_id, limit))
+        # Buffered plays keep their own viewed_at; items without one get NOW()
+        execute_values(cur, """
+            INSERT INTO view_history (user_id, video_id, title, channel, duration, viewed_at)
+            VALUES %s
+        """, [
+            (user_id, i['video_id'], i.get('title', ''), i.get('channel', ''), i.get('duration', 0),
+             i.get('viewed_at'))
+            for i in items
+        ], template="(%s, %s, %s, %s, %s, COALESCE(%s, NOW()))")
+
+def get_user_history(user_id, limit=50, before=None):
+    """Get user's view history, newest first.
+
+    Pass before=(viewed_at, id) of the last row seen to get the next page;
+    id breaks ties between plays recorded at the same instant.
+    """
+    with get_db() as conn:
+        cur = conn.cursor()
+        if before:
+            cur.execute("""
+                SELECT id, video_id, title, channel, duration, viewed_at
+                FROM view_history
+                WHERE user_id = %s AND (viewed_at, id) < (%s, %s)
+                ORDER BY viewed_at DESC, id DESC
+                LIMIT %s
+            """, (user_id, *before, limit))
+        else:
+            cur.execute("""
+                SELECT id, video_id, title, channel, duration, viewed_at
+                FROM view_history
+                WHERE user_id = %s
+                ORDER BY viewed_at DESC, id DESC
+                LIMIT %s
+            """, (user_id, limit))
         return [dict(row) for row in cur.fetchall()]
 
 # Cache operations
-def get_cached_stream(video_id, max_age_hours=4):
-    """Get cached stream URL if fresh"""
+def get_cached_stream(video_id, max_age_hours=4, error_max_age_minutes=10):
+    """Get cached stream entry if fresh: {'audio_url', 'error'} or None"""
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("""
-            SELECT audio_url FROM stream_cache
+            SELECT audio_url, error FROM stream_cache
             WHERE video_id = %s
-            AND cached_at > NOW() - INTERVAL '%s hours'
-        """, (video_id, max_age_hours))
+            AND cached_at > NOW() - CASE WHEN error IS NULL
+                THEN make_interval(hours => %s)
+                ELSE make_interval(mins => %s)
+            END
+        """, (video_id, max_age_hours, error_max_age_minutes))
         row = cur.fetchone()
-        return row['audio_url'] if row else None
+        return dict(row) if row else None
 
 def cache_stream(video_id, audio_url):
     """Cache a stream URL"""
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("""
-            INSERT INTO stream_cache (video_id, audio_url, cached_at)
-            VALUES (%s, %s, NOW())
-            ON CONFLICT (video_id) DO UPDATE SET audio_url = %s, cached_at = NOW()
+            INSERT INTO stream_cache (video_id, audio_url, error, cached_at)
+            VALUES (%s, %s, NULL, NOW())
+            ON CONFLICT (video_id) DO UPDATE SET audio_url = %s, error = NULL, cached_at = NOW()
         """, (video_id, audio_url, audio_url))
 
-def cleanup_old_cache(max_age_hours=6):
-    """Remove old cache entries"""
+def cache_stream_error(video_id, error='fetch_failed'):
+    """Remember a failed stream lookup (short error code) so it isn't retried right away"""
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("""
-            DELETE FROM stream_cache
-            WHERE cached_at < NOW() - INTERVAL '%s hours'
-        """, (max_age_hours,))
+            INSERT INTO stream_cache (video_id, audio_url, error, cached_at)
+            VALUES (%s, NULL, %s, NOW())
+            ON CONFLICT (video_id) DO UPDATE SET audio_url = NULL, error = %s, cached_at = NOW()
+        """, (video_id, error, error))
+
+def cleanup_old_cache(max_age_hours=6):
+    """Remove old cache entries"""
+    return _delete_in_batches(
+        'stream_cache', "cached_at < NOW() - make_interval(hours => %s)", (max_age_hours,)
+    )
 
 def get_user_count():
     """Get total number of registered users"""
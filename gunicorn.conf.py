@@ -0,0 +1,12 @@
+import os
+
+# Handlers spend nearly all their time waiting on YouTube or Postgres,
+# so run many threads per worker rather than many workers.
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+timeout = 120
+
+# One pooled DB connection per thread in each worker
+os.environ.setdefault('DB_POOL_MAX', str(threads))
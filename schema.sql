@@ -32,11 +32,24 @@ CREATE TABLE IF NOT EXISTS view_history (
 -- Stream URL cache
 CREATE TABLE IF NOT EXISTS stream_cache (
     video_id VARCHAR(20) PRIMARY KEY,
-    audio_url TEXT NOT NULL,
+    audio_url TEXT,
+    error VARCHAR(32),
     cached_at TIMESTAMP DEFAULT NOW()
 );
 
+-- Login sessions
+CREATE TABLE IF NOT EXISTS sessions (
+    token VARCHAR(64) PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+    expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
 -- Indexes for performance
-CREATE INDEX IF NOT EXISTS idx_history_user ON view_history(user_id, viewed_at DESC);
-CREATE INDEX IF NOT EXISTS idx_tokens_lookup ON auth_tokens(token, expires_at);
+CREATE INDEX IF NOT EXISTS idx_history_user_seek ON view_history(user_id, viewed_at DESC, id DESC);
+DROP INDEX IF EXISTS idx_history_user;
+DROP INDEX IF EXISTS idx_tokens_lookup;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tokens_active ON auth_tokens(token) WHERE used = FALSE;
+CREATE INDEX IF NOT EXISTS idx_cache_vid_cover ON stream_cache(video_id) INCLUDE (audio_url, error, cached_at);
 CREATE INDEX IF NOT EXISTS idx_cache_age ON stream_cache(cached_at);
+CREATE INDEX IF NOT EXISTS idx_sessions_expiry ON sessions(expires_at);
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+import app as app_module
+
+
+def _entries(n):
+    for i in range(n):
+        yield {'id': f'vid{i:08d}', 'title': f'Title {i}', 'channel': 'Chan', 'duration': 60 + i}
+
+
+class FakeYoutubeDL:
+    """Stands in for yt-dlp: returns a lazy entries generator like process=False"""
+    count = 30
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def extract_info(self, url, download=False, process=True):
+        return {'entries': _entries(self.count)}
+
+
+def _broken_entries():
+    yield from _entries(3)
+    raise RuntimeError('page fetch failed')
+
+
+class BrokenMidwayYoutubeDL(FakeYoutubeDL):
+    def extract_info(self, url, download=False, process=True):
+        return {'entries': _broken_entries()}
+
+
+class FailingYoutubeDL(FakeYoutubeDL):
+    def extract_info(self, url, download=False, process=True):
+        raise RuntimeError('boom')
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app_module, 'YoutubeDL', FakeYoutubeDL)
+    app_module.app.config['TESTING'] = True
+    return app_module.app.test_client()
+
+
+def test_search_returns_first_18_results(client):
+    res = client.get('/api/search?q=test')
+    assert res.status_code == 200
+    videos = res.get_json()
+    assert len(videos) == 18
+    assert videos[0]['id'] == 'vid00000000'
+    assert videos[0]['url'] == 'https://youtube.com/watch?v=vid00000000'
+
+
+def test_search_empty_query(client):
+    res = client.get('/api/search')
+    assert res.status_code == 200
+    assert res.get_json() == []
+
+
+def test_search_failure_returns_error(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'YoutubeDL', FailingYoutubeDL)
+    res = client.get('/api/search?q=test')
+    assert res.status_code == 500
+    assert res.get_json() == {'error': 'boom'}
+
+
+def test_search_streams_ndjson_when_asked(client):
+    res = client.get('/api/search?q=test', headers={'Accept': 'application/x-ndjson'})
+    assert res.status_code == 200
+    assert res.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+    assert len(lines) == 18
+    assert lines[-1]['id'] == 'vid00000017'
+
+
+def test_search_stream_reports_midway_failure(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'YoutubeDL', BrokenMidwayYoutubeDL)
+    res = client.get('/api/search?q=test', headers={'Accept': 'application/x-ndjson'})
+    lines = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+    assert [line.get('id') for line in lines[:3]] == ['vid00000000', 'vid00000001', 'vid00000002']
+    assert lines[-1] == {'error': 'page fetch failed'}
+
+
+def test_search_json_midway_failure_is_an_error(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'YoutubeDL', BrokenMidwayYoutubeDL)
+    res = client.get('/api/search?q=test')
+    assert res.status_code == 500
+    assert res.get_json() == {'error': 'page fetch failed'}